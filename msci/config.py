@@ -10,6 +10,17 @@ class Config(BaseSettings, env_prefix="MSCI_"):
     wiki_thread_count: int = Field(
         ge=1, default=200, description="Must have at least one worker"
     )
+    wiki_batch_size: int = Field(
+        ge=1, le=50, default=20, description="Titles per links call, at most 50"
+    )
+    wiki_cache_size: int = Field(
+        ge=1,
+        default=1_000_000,
+        description="Words, and separately links, of articles kept across jobs",
+    )
+    wiki_cache_ttl: int = Field(
+        ge=0, default=3600, description="Seconds a cached article is kept"
+    )
     wiki_api_url: str = "https://en.wikipedia.org/w/api.php"
     wiki_user_agent: str = "MSCI-test/1.0 (contact@example.com)"
     wiki_access_token: str | None = None
@@ -1,9 +1,7 @@
 """msci main app"""
 
 from typing import Annotated
-import asyncio
 
-import numpy as np
 from fastapi import FastAPI, Depends, HTTPException, Query
 
 from msci import models
@@ -14,34 +12,26 @@ from msci.wiki_word_frequency import WikiWordFrequency
 app = FastAPI(title="msci", lifespan=lifespan)  # pylint: disable=unused-argument
 
 
-def get_wiki_word_freq():
-    """Get wiki"""
+async def get_wiki_word_freq():
+    """Get wiki
+
+    Declared async so FastAPI resolves it on the event loop instead of
+    dispatching it to its threadpool on every request.
+    """
     return get_wiki()
 
 
-# pylint: disable=dangerous-default-value
-async def handle_work(
-    wiki, key, ignore_list: list[str] | None = None, percentile: int | None = None
-):
+async def handle_work(wiki, key):
     """Handle work retrieval"""
-    while (result := wiki.get_result(key)) is None:
-        await asyncio.sleep(0.1)
+    await wiki.wait(key)
+    result = wiki.get_result(key)
     wiki.cleanup(key)
     if not result.success:
         raise HTTPException(
             status_code=500,
             detail={"message": result.error},
         )
-    words = result.words
-    if ignore_list is not None:
-        for word in ignore_list:
-            words.pop(word, None)
-
-    if percentile is not None:
-        counts = np.array(list(words.values()))
-        threshold = np.percentile(counts, percentile)
-        return {word: count for word, count in words.items() if count < threshold}
-    return words
+    return result.words
 
 
 @app.get(
@@ -71,5 +61,5 @@ async def post_word_freq(
 ):
     """POST Keywords"""
 
-    key = wiki.add_job(data.article, data.depth)
-    return await handle_work(wiki, key, data.ignore_list, data.percentile)
+    key = wiki.add_job(data.article, data.depth, data.ignore_list, data.percentile)
+    return await handle_work(wiki, key)
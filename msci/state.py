@@ -23,6 +23,9 @@ def get_wiki() -> WikiWordFrequency:
     config = get_config()
     return WikiWordFrequency(
         max_workers=config.wiki_thread_count,
+        batch_size=config.wiki_batch_size,
+        cache_size=config.wiki_cache_size,
+        cache_ttl=config.wiki_cache_ttl,
         api_url=config.wiki_api_url,
         user_agent=config.wiki_user_agent,
         access_token=config.wiki_access_token,
@@ -32,5 +35,9 @@ def get_wiki() -> WikiWordFrequency:
 @asynccontextmanager
 async def lifespan(app: FastAPI):  # pylint: disable=unused-argument
     """lifespan"""
-    get_wiki()
-    yield
+    wiki = get_wiki()
+    try:
+        yield
+    finally:
+        wiki.close()
+        get_wiki.cache_clear()
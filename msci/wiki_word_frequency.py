@@ -1,19 +1,72 @@
 """Process pages"""
 
 from collections import Counter
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass
 from functools import partial
 from threading import Lock
+import asyncio
 import logging
+import multiprocessing
+import random
 import re
 import time
 import uuid
 
+import numpy as np
+import orjson
 import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
 
 log = logging.getLogger(__name__)
-word_re = re.compile(r"[^\w\-/']", re.UNICODE)
+_TOKEN_RE = re.compile(r"[\w][\w\-/']*", re.UNICODE)
+
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+MAX_TRIES = 5
+
+
+def _calculate_words(text):
+    """Count the words of a text, runs in the process pool"""
+    return Counter(_TOKEN_RE.findall(text))
+
+
+def _new_cpu_executor():
+    """Create the process pool counting the words"""
+    return ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver"))
+
+
+def _page_title(articles, normalized, content):
+    """Return the requested title a page of a response belongs to, if known"""
+    if len(articles) == 1:
+        return articles[0]
+    title = content.get("title")
+    title = normalized.get(title, title)
+    return title if title in articles else None
+
+
+def _cache_entry_size(value):
+    """Size of a cache entry, the number of words or links plus one"""
+    return len(value) + 1
+
+
+def _filter_words(words, ignore_list=None, percentile=None):
+    """Drop the ignored words and the words at or above the count percentile"""
+    for word in ignore_list or ():
+        words.pop(word, None)
+    if percentile is None or not words:
+        return words
+    # counts are small non-negative integers, so the order statistics
+    # np.percentile interpolates between can be read off the histogram's
+    # CDF without sorting
+    counts = np.fromiter(words.values(), dtype=np.int32, count=len(words))
+    cdf = np.cumsum(np.bincount(counts))
+    rank = (len(counts) - 1) * percentile / 100
+    low, high = np.searchsorted(cdf, [int(rank) + 1, min(int(rank) + 2, len(counts))])
+    threshold = low + (rank - int(rank)) * (high - low)
+    return {word: count for word, count in words.items() if count < threshold}
 
 
 class WikiError(Exception):
@@ -44,23 +97,44 @@ class WikiWordFrequency:
         api_url: str,
         user_agent: str,
         access_token: str | None = None,
-        batch_size: int = 5,
+        batch_size: int = 20,
+        cache_size: int = 1_000_000,
+        cache_ttl: int = 3600,
     ):
         """Init WikiWordFrequency.
 
+        The API calls run in a ThreadPoolExecutor, the word counting runs in a
+        ProcessPoolExecutor with one process per CPU.
+
         Args:
             max_workers: number of workers in ThreadPoolExecutor
             api_url: wikipedia API url
             user_agent: user agent for the API calls
             access_token (optional): access token to extend rate limits
+            batch_size (optional): number of titles queried in one links call
+            cache_size (optional): number of words, and separately of links,
+                of single articles kept for other jobs
+            cache_ttl (optional): seconds a cached article is kept
         """
 
         self._executor = ThreadPoolExecutor(max_workers=max_workers)
-        self._futures = {}
+        self._cpu_executor = _new_cpu_executor()
+        self._cpu_lock = Lock()
+        self._outstanding = {}
         self._links = {}
         self._results = {}
         self._words = {}
-        self._lock = Lock()
+        self._filters = {}
+        self._events = {}
+        self._job_locks = {}
+        self._table_lock = Lock()
+        self._words_cache = TTLCache(
+            maxsize=cache_size, ttl=cache_ttl, getsizeof=_cache_entry_size
+        )
+        self._links_cache = TTLCache(
+            maxsize=cache_size, ttl=cache_ttl, getsizeof=_cache_entry_size
+        )
+        self._cache_lock = Lock()
 
         self.batch_size = batch_size
         self.api_url = api_url
@@ -68,32 +142,64 @@ class WikiWordFrequency:
         if access_token:
             self.headers["Authorization"] = f"Bearer {access_token}"
 
+        self._session = requests.Session()
+        self._session.headers.update(self.headers)
+        self._session.params = {"action": "query", "format": "json"}
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def close(self):
+        """Stop the workers and release the pooled HTTP connections
+
+        Queued tasks are cancelled, running ones are not waited for.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._cpu_executor.shutdown(wait=False, cancel_futures=True)
+        self._session.close()
+
+    def _backoff(self, reason, prev, retry_after=None):
+        """Sleep before the next retry and return the delay used
+
+        Honours Retry-After when given, up to BACKOFF_CAP, otherwise uses
+        decorrelated jitter so the worker threads do not retry in lockstep.
+        """
+        if retry_after:
+            delay = min(retry_after, BACKOFF_CAP) + random.uniform(0, 1)
+            source = "retry-after"
+        else:
+            delay = min(
+                BACKOFF_CAP,
+                random.uniform(BACKOFF_BASE, max(prev, BACKOFF_BASE) * 3),
+            )
+            source = "backoff"
+        log.warning("%s - sleeping for %.1fs (%s)", reason, delay, source)
+        time.sleep(delay)
+        return delay
+
     def _get_response(self, params):
         """Get response from wikipedia API
 
-        Will retry up to 5 times in case of timeout/HTTP 429
+        Will try up to MAX_TRIES times in case of timeout/HTTP 429, without
+        sleeping after the last try
         """
+        delay = BACKOFF_BASE
         try_cnt = 0
-        while try_cnt < 5:
+        while try_cnt < MAX_TRIES:
             try_cnt += 1
             try:
-                response = requests.get(
-                    self.api_url, headers=self.headers, params=params, timeout=3
-                )
+                response = self._session.get(self.api_url, params=params, timeout=3)
                 if response.status_code == 200:
-                    return response.json()
+                    return orjson.loads(response.content)
                 if response.status_code == 429:
                     try:
                         retry_after = int(response.headers.get("Retry-After"))
-                        log.warning(
-                            "HTTP 429 - sleeping for %ds (retry-after)", retry_after + 1
-                        )
-                        time.sleep(retry_after + 1)
                     except (ValueError, TypeError):
-                        log.warning(
-                            "HTTP 429 - sleeping for %ds (fallback)", 2 * 3**try_cnt
-                        )
-                        time.sleep(2 * 3**try_cnt)
+                        retry_after = None
+                    if try_cnt == MAX_TRIES:
+                        log.warning("HTTP 429")
+                        break
+                    delay = self._backoff("HTTP 429", delay, retry_after)
                     continue
                 log.warning("HTTP %d", response.status_code)
                 raise WikiError(
@@ -103,36 +209,105 @@ class WikiWordFrequency:
                     )
                 )
             except requests.exceptions.Timeout:
-                log.warning("Timeout")
-                time.sleep(2 * 3**try_cnt)
+                if try_cnt == MAX_TRIES:
+                    log.warning("Timeout")
+                    break
+                delay = self._backoff("Timeout", delay)
                 continue
         log.warning("Retries exhausted")
         raise WikiError("Could not get response from wikipedia (timeout)")
 
+    def _cached(self, cache, articles, fetch):
+        """Return the results for articles, only fetching the uncached ones
+
+        Results are cached per article so that jobs batching different
+        articles together still share them. They are shared between jobs and
+        must not be mutated.
+
+        Returns:
+            list of the results of the single articles
+        """
+        results = []
+        missing = []
+        with self._cache_lock:
+            for article in articles:
+                result = cache.get(article)
+                if result is None:
+                    missing.append(article)
+                else:
+                    results.append(result)
+        if missing:
+            fetched = fetch(missing)
+            with self._cache_lock:
+                for article, result in fetched.items():
+                    if article is None:
+                        continue
+                    try:
+                        cache[article] = result
+                    except ValueError:  # larger than the whole cache
+                        pass
+            results.extend(fetched.values())
+        return results
+
     def _get_words(self, articles: list[str]):
-        """Get word count for articles"""
-        log.info("Getting words for %s", ",".join(articles))
+        """Get word count for articles
+
+        Returns:
+            list of word counters, one per article
+        """
+        return self._cached(self._words_cache, articles, self._fetch_words)
+
+    def _get_links(self, articles: list[str]):
+        """Get links for articles"""
+        links = self._cached(self._links_cache, articles, self._fetch_links)
+        return set().union(*links)
 
-        def calculate_words(text):
-            words = Counter()
-            words.update([word_re.sub("", w) for w in text.split()])
-            words.pop("", None)
-            return words
+    def _count_words(self, extracts):
+        """Count the words of each extract in the process pool
 
+        A pool broken by a dead worker stays broken, so it is replaced for the
+        following calls and this call counts the words in the thread instead.
+        """
+        executor = self._cpu_executor
+        try:
+            return list(executor.map(_calculate_words, extracts))
+        except BrokenProcessPool:
+            log.warning("Process pool is broken, replacing it")
+            with self._cpu_lock:
+                if self._cpu_executor is executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._cpu_executor = _new_cpu_executor()
+            return [_calculate_words(extract) for extract in extracts]
+
+    def _fetch_words(self, articles: list[str]):
+        """Get word count for articles from the API
+
+        Returns:
+            dict of word counters by article, pages which can not be matched
+            to an article are under None
+        """
+        log.info("Getting words for %s", ",".join(articles))
         params = {
-            "action": "query",
-            "format": "json",
             "prop": "extracts",
-            "explaintext": True,
+            "explaintext": "1",
             "exlimit": "max",
             "titles": "|".join(articles),
         }
-        all_words = Counter()
+        all_words = {}
         while True:
             response = self._get_response(params)
-            pages = response.get("query", {}).get("pages", {})
-            for _, content in pages.items():
-                all_words += calculate_words(content.get("extract", ""))
+            query = response.get("query", {})
+            normalized = {n["to"]: n["from"] for n in query.get("normalized", [])}
+            titles = []
+            extracts = []
+            for content in query.get("pages", {}).values():
+                title = _page_title(articles, normalized, content)
+                all_words.setdefault(title, Counter())
+                if extract := content.get("extract"):
+                    titles.append(title)
+                    extracts.append(extract)
+            for title, words in zip(titles, self._count_words(extracts)):
+                all_words[title].update(words)
             if "continue" in response:
                 params.update(response["continue"])
             else:
@@ -140,23 +315,28 @@ class WikiWordFrequency:
         log.info("Done getting words for %s", ",".join(articles))
         return all_words
 
-    def _get_links(self, articles: list[str]):
-        """Get links for articles"""
+    def _fetch_links(self, articles: list[str]):
+        """Get links for articles from the API
+
+        Returns:
+            dict of link sets by article, pages which can not be matched to an
+            article are under None
+        """
         log.info("Getting links for %s", ",".join(articles))
         params = {
-            "action": "query",
-            "format": "json",
             "prop": "links",
             "pllimit": "max",
             "plnamespace": 0,
             "titles": "|".join(articles),
         }
-        all_links = set()
+        all_links = {}
         while True:
             response = self._get_response(params)
-            pages = response.get("query", {}).get("pages", {})
-            for _, content in pages.items():
-                all_links.update(
+            query = response.get("query", {})
+            normalized = {n["to"]: n["from"] for n in query.get("normalized", [])}
+            for content in query.get("pages", {}).values():
+                title = _page_title(articles, normalized, content)
+                all_links.setdefault(title, set()).update(
                     [link.get("title") for link in content.get("links", [])]
                 )
             if "continue" in response:
@@ -166,38 +346,56 @@ class WikiWordFrequency:
         log.info("Done getting links for %s", ",".join(articles))
         return all_links
 
+    def _notify(self, key):
+        """Wake up the coroutine waiting for the job, if any"""
+        loop, event = self._events.pop(key, (None, None))
+        if loop is not None:
+            loop.call_soon_threadsafe(event.set)
+
+    def _drop_state(self, key):
+        """Drop the in-progress state of a job"""
+        self._words.pop(key, None)
+        self._links.pop(key, None)
+        self._outstanding.pop(key, None)
+        self._filters.pop(key, None)
+
     def _error(self, key, message):
         if key in self._results:
             return
         res = WikiResult(success=False, error=message)
         self._results.update({key: res})
-        self._words.pop(key, None)
-        self._links.pop(key, None)
-        self._futures.pop(key, None)
+        self._drop_state(key)
+        self._notify(key)
 
     def _finished(self, key):
         if key in self._results:
             return
-        if key not in self._futures:
+        if key not in self._outstanding or self._outstanding[key] > 0:
             return
-        if len(self._futures[key]) > 0:
-            return
-        words = self._words.pop(key, {})
+        words = _filter_words(self._words.pop(key, {}), *self._filters[key])
         res = WikiResult(success=True, words=words)
         self._results.update({key: res})
-        self._links.pop(key, None)
-        self._futures.pop(key, None)
+        self._drop_state(key)
+        self._notify(key)
+
+    def _job_lock(self, key):
+        """Return the lock guarding the state of a job, None if cleaned up"""
+        with self._table_lock:
+            return self._job_locks.get(key)
 
     def _merge_words(self, key, future):
         """Merge words with existing data"""
         log.info("Merge words for %s", key)
-        with self._lock:
-            if key not in self._futures:
+        lock = self._job_lock(key)
+        if lock is None:
+            return
+        with lock:
+            if key not in self._outstanding:
                 return
-            self._futures[key].discard(future)
+            self._outstanding[key] -= 1
             try:
-                result = future.result()
-                self._words[key] += result
+                for words in future.result():
+                    self._words[key].update(words)
             except WikiError as e:
                 self._error(key, e.message)
             except Exception:  # pylint: disable=broad-exception-caught
@@ -209,29 +407,39 @@ class WikiWordFrequency:
     def _merge_links(self, key, depth, max_depth, future):
         """Merge links with existing data"""
         log.info("Merge links for %s", key)
-        with self._lock:
-            if key not in self._futures:
+        lock = self._job_lock(key)
+        if lock is None:
+            return
+        submitted = []
+        with lock:
+            if key not in self._outstanding:
                 return
-            self._futures[key].discard(future)
+            self._outstanding[key] -= 1
             try:
                 result = future.result()
-                links = []
-                for link in result:
-                    if link in self._links[key]:
-                        continue
-                    self._links[key].add(link)
-                    links.append(link)
-                for i in range(0, len(links), self.batch_size):
-                    articles = links[i : i + self.batch_size]
-                    future = self._executor.submit(self._get_words, articles)
-                    future.add_done_callback(partial(self._merge_words, key))
-                    self._futures[key].add(future)
-                    if depth < max_depth:
-                        future = self._executor.submit(self._get_links, articles)
-                        future.add_done_callback(
-                            partial(self._merge_links, key, depth + 1, max_depth)
+                seen = self._links[key]
+                new_links = result - seen
+                seen.update(new_links)
+                # without exintro the API returns a single whole-article extract
+                # per call, so extracts are requested one title at a time
+                for link in new_links:
+                    submitted.append(
+                        (
+                            self._executor.submit(self._get_words, [link]),
+                            partial(self._merge_words, key),
                         )
-                        self._futures[key].add(future)
+                    )
+                if depth < max_depth:
+                    links = list(new_links)
+                    for i in range(0, len(links), self.batch_size):
+                        articles = links[i : i + self.batch_size]
+                        submitted.append(
+                            (
+                                self._executor.submit(self._get_links, articles),
+                                partial(self._merge_links, key, depth + 1, max_depth),
+                            )
+                        )
+                self._outstanding[key] += len(submitted)
             except WikiError as e:
                 self._error(key, e.message)
             except Exception:  # pylint: disable=broad-exception-caught
@@ -239,32 +447,74 @@ class WikiWordFrequency:
                 log.error("Task failed", exc_info=True)
             finally:
                 self._finished(key)
+        # callbacks of already finished futures run right away in this thread,
+        # so they can only be attached once the job lock is released
+        for new_future, callback in submitted:
+            new_future.add_done_callback(callback)
 
     def add_job(
         self,
         article: str,
         depth: int,
+        ignore_list: list[str] | None = None,
+        percentile: int | None = None,
     ):
         """Add job
 
+        The filters are applied by the worker finishing the job, so the
+        result is ready to be returned as is.
+
         Args:
             article: article name
             depth: depth to traverse
+            ignore_list (optional): words to leave out of the result
+            percentile (optional): leave out the words whose count is at or
+                above this percentile of all counts
         """
         key = uuid.uuid4()
 
         self._words.update({key: Counter()})
-        self._links.update({key: set()})
-
-        futures = [self._executor.submit(self._get_words, [article])]
-        futures[0].add_done_callback(partial(self._merge_words, key))
+        self._links.update({key: {article}})
+        self._filters.update({key: (ignore_list, percentile)})
+        try:
+            self._events.update({key: (asyncio.get_running_loop(), asyncio.Event())})
+        except RuntimeError:
+            pass
+
+        submitted = [
+            (
+                self._executor.submit(self._get_words, [article]),
+                partial(self._merge_words, key),
+            )
+        ]
         if depth > 0:
-            futures.append(self._executor.submit(self._get_links, [article]))
-            futures[-1].add_done_callback(partial(self._merge_links, key, 1, depth))
+            submitted.append(
+                (
+                    self._executor.submit(self._get_links, [article]),
+                    partial(self._merge_links, key, 1, depth),
+                )
+            )
 
-        self._futures.update({key: set(futures)})
+        self._outstanding.update({key: len(submitted)})
+        with self._table_lock:
+            self._job_locks.update({key: Lock()})
+        for future, callback in submitted:
+            future.add_done_callback(callback)
         return key
 
+    async def wait(self, key):
+        """Wait for a job to finish
+
+        Only jobs added from a running event loop can be awaited, otherwise
+        this returns immediately and get_result has to be polled.
+
+        Args:
+            key: id return from add_job
+        """
+        _, event = self._events.get(key, (None, None))
+        if event is not None:
+            await event.wait()
+
     def get_result(self, key):
         """Get job result
 
@@ -275,10 +525,7 @@ class WikiWordFrequency:
             None: the job is not yet finished
             dict: data
         """
-        with self._lock:
-            if key not in self._results:
-                return None
-            return self._results[key]
+        return self._results.get(key)
 
     def cleanup(self, key):
         """Clean job result
@@ -286,8 +533,11 @@ class WikiWordFrequency:
         Args:
             key: id return from add_job
         """
-        with self._lock:
+        with self._table_lock:
+            lock = self._job_locks.pop(key, None)
+        if lock is None:
+            return
+        with lock:
             self._results.pop(key, None)
-            self._words.pop(key, None)
-            self._links.pop(key, None)
-            self._futures.pop(key, None)
+            self._drop_state(key)
+            self._events.pop(key, None)
@@ -106,6 +106,28 @@ def test_api_get_error(env, server):
     }
 
 
+@pytest.fixture
+def fresh_wiki():
+    yield
+    get_wiki().close()
+    get_wiki.cache_clear()
+
+
+def test_api_lifespan(env, server, mocker, fresh_wiki):
+    wiki = get_wiki()
+    executor_shutdown = mocker.spy(wiki._executor, "shutdown")
+    cpu_executor_shutdown = mocker.spy(wiki._cpu_executor, "shutdown")
+    session_close = mocker.spy(wiki._session, "close")
+    with TestClient(app) as client:
+        resp = client.get("/word-frequency", params={"article": "title1", "depth": 0})
+        assert resp.status_code == 200
+        executor_shutdown.assert_not_called()
+    executor_shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+    cpu_executor_shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+    session_close.assert_called_once_with()
+    assert get_wiki() is not wiki
+
+
 def test_api_real():
     get_config.cache_clear()
     get_wiki.cache_clear()
@@ -1,9 +1,11 @@
 """test wiki"""
 
+from concurrent.futures.process import BrokenProcessPool
 from unittest.mock import call
 import copy
+import time
 
-from msci.wiki_word_frequency import WikiWordFrequency
+from msci.wiki_word_frequency import WikiWordFrequency, _filter_words
 
 EXTRACT_RESPONSE = {
     "query": {"pages": {"1": {"title": "title", "extract": "Some words here."}}}
@@ -30,7 +32,7 @@ def test_wiki_extract(http_testserver):
         "action": "query",
         "format": "json",
         "prop": "extracts",
-        "explaintext": "True",
+        "explaintext": "1",
         "exlimit": "max",
         "titles": "test",
     }
@@ -41,7 +43,7 @@ def test_wiki_extract(http_testserver):
     assert key not in wiki._results
     assert key not in wiki._words
     assert key not in wiki._links
-    assert key not in wiki._futures
+    assert key not in wiki._outstanding
 
 
 def test_wiki_links(http_testserver):
@@ -137,12 +139,14 @@ def test_wiki_error(http_testserver):
         pass
     assert not result.success
     assert result.error == "Could not get response from wikipedia because of HTTP 500"
+    wiki._executor.shutdown()
 
 
 def test_wiki_retry(http_testserver, mocker):
     resp = [({}, 429, {"Retry-After": "2"}), ({}, 429), (EXTRACT_RESPONSE)]
     resp_gen = (r for r in resp)
     sleep_mock = mocker.patch("time.sleep")
+    mocker.patch("random.uniform", side_effect=lambda low, high: high)
 
     def callback():
         return next(resp_gen)
@@ -154,4 +158,230 @@ def test_wiki_retry(http_testserver, mocker):
         pass
     assert result.success
     assert result.words == {"Some": 1, "words": 1, "here": 1}
-    assert sleep_mock.call_args_list == [call(3), call(18)]
+    assert sleep_mock.call_args_list == [call(3), call(9)]
+
+
+def test_wiki_retries_exhausted(http_testserver, mocker):
+    sleep_mock = mocker.patch("time.sleep")
+    mocker.patch("random.uniform", side_effect=lambda low, high: high)
+
+    def callback():
+        return {}, 429
+
+    http_testserver.add_callback("/", callback)
+    wiki = WikiWordFrequency(1, http_testserver.url, "test")
+    key = wiki.add_job("test", 0)
+    while (result := wiki.get_result(key)) is None:
+        pass
+    assert not result.success
+    assert len(http_testserver.request_log) == 5
+    # no sleep after the last try
+    assert sleep_mock.call_args_list == [call(3), call(9), call(27), call(60)]
+
+
+def test_wiki_retry_after_capped(http_testserver, mocker):
+    resp = [({}, 429, {"Retry-After": "3600"}), (EXTRACT_RESPONSE)]
+    resp_gen = (r for r in resp)
+    sleep_mock = mocker.patch("time.sleep")
+    mocker.patch("random.uniform", side_effect=lambda low, high: high)
+
+    def callback():
+        return next(resp_gen)
+
+    http_testserver.add_callback("/", callback)
+    wiki = WikiWordFrequency(1, http_testserver.url, "test")
+    key = wiki.add_job("test", 0)
+    while (result := wiki.get_result(key)) is None:
+        pass
+    assert result.success
+    assert sleep_mock.call_args_list == [call(61)]
+
+
+def test_wiki_links_two_depths(http_testserver):
+    # every yN is 3 links away through TN and 4 through another mN, only the
+    # shorter path may count, otherwise the links of yN are not followed
+    graph = {"test": ["a", "b", "e"], "e": ["f"]}
+    graph["a"] = graph["b"] = ["T1", "T2", "T3"]
+    for i in range(1, 4):
+        graph[f"T{i}"] = [f"y{i}", f"m{i}"]
+        graph[f"m{i}"] = [f"y{j}" for j in range(1, 4) if j != i]
+        graph[f"y{i}"] = [f"z{i}"]
+
+    def callback():
+        req = http_testserver.request
+        titles = req.args.get("titles").split("|")
+        prop = req.args.get("prop")
+        if prop == "links":
+            if "e" in titles:
+                # keeps a link call outstanding while the others go deeper
+                time.sleep(0.2)
+            links = [{"title": link} for t in titles for link in graph.get(t, [])]
+            return {"query": {"pages": {"1": {"links": links}}}}
+        resp = {}
+        for i, t in enumerate(titles):
+            resp[i] = {"title": t, "extract": t}
+        return {"query": {"pages": resp}}
+
+    http_testserver.add_callback("/", callback)
+    wiki = WikiWordFrequency(10, http_testserver.url, "test", batch_size=2)
+    key = wiki.add_job("test", 4)
+    while (result := wiki.get_result(key)) is None:
+        pass
+    assert result.success
+    assert set(result.words) == set(graph) | {"f", "z1", "z2", "z3"}
+
+
+def test_wiki_extracts_per_title(http_testserver):
+    extract_requests = []
+
+    def callback():
+        req = http_testserver.request
+        titles = req.args.get("titles").split("|")
+        if req.args.get("prop") == "links":
+            links = [{"title": "title1"}, {"title": "title2"}, {"title": "title3"}]
+            return {"query": {"pages": {"1": {"links": links}}}}
+        # like TextExtracts without exintro: one whole extract per call
+        extract_requests.append(dict(req.args))
+        offset = int(req.args.get("excontinue", 0))
+        resp = {"query": {"pages": {"1": {"title": titles[offset]}}}}
+        resp["query"]["pages"]["1"]["extract"] = titles[offset]
+        if offset + 1 < len(titles):
+            resp["continue"] = {"excontinue": offset + 1, "continue": "||"}
+        return resp
+
+    http_testserver.add_callback("/", callback)
+    wiki = WikiWordFrequency(10, http_testserver.url, "test")
+    key = wiki.add_job("test", 1)
+    while (result := wiki.get_result(key)) is None:
+        pass
+    assert result.success
+    assert result.words == {"test": 1, "title1": 1, "title2": 1, "title3": 1}
+    assert len(extract_requests) == 4
+    assert all("|" not in r["titles"] for r in extract_requests)
+    assert not any("excontinue" in r for r in extract_requests)
+
+
+def test_wiki_cache(http_testserver):
+    def callback():
+        return EXTRACT_RESPONSE
+
+    http_testserver.add_callback("/", callback)
+    wiki = WikiWordFrequency(10, http_testserver.url, "test")
+    for _ in range(2):
+        key = wiki.add_job("test", 0)
+        while (result := wiki.get_result(key)) is None:
+            pass
+        assert result.words == {"here": 1, "words": 1, "Some": 1}
+    assert http_testserver.request_log == ["GET /"]
+
+
+def test_wiki_links_to_root(http_testserver):
+    def callback():
+        req = http_testserver.request
+        titles = req.args.get("titles").split("|")
+        if req.args.get("prop") == "links":
+            links = [{"title": "test"}, {"title": "title1"}]
+            return {"query": {"pages": {"1": {"links": links}}}}
+        resp = {}
+        for i, t in enumerate(titles):
+            resp[i] = {"title": t, "extract": t}
+        return {"query": {"pages": resp}}
+
+    http_testserver.add_callback("/", callback)
+    wiki = WikiWordFrequency(10, http_testserver.url, "test")
+    key = wiki.add_job("test", 2)
+    while (result := wiki.get_result(key)) is None:
+        pass
+    assert result.success
+    assert result.words == {"test": 1, "title1": 1}
+
+
+def test_wiki_cache_per_title(http_testserver):
+    links = {"test": ["title1", "title2"], "title1": ["a"], "title2": ["b"]}
+
+    def callback():
+        req = http_testserver.request
+        titles = req.args.get("titles").split("|")
+        resp = {}
+        for i, t in enumerate(titles):
+            if req.args.get("prop") == "links":
+                page_links = [{"title": link} for link in links.get(t, [])]
+                resp[i] = {"title": t, "links": page_links}
+            else:
+                resp[i] = {"title": t, "extract": t}
+        return {"query": {"pages": resp}}
+
+    http_testserver.add_callback("/", callback)
+    wiki = WikiWordFrequency(10, http_testserver.url, "test")
+    key = wiki.add_job("test", 2)
+    while (result := wiki.get_result(key)) is None:
+        pass
+    assert result.words == {"test": 1, "title1": 1, "title2": 1, "a": 1, "b": 1}
+    request_count = len(http_testserver.request_log)
+
+    # title2 was only queried in a batch with title1, its results are reused
+    key = wiki.add_job("title2", 1)
+    while (result := wiki.get_result(key)) is None:
+        pass
+    assert result.words == {"title2": 1, "b": 1}
+    assert len(http_testserver.request_log) == request_count
+
+
+def test_wiki_cache_size(http_testserver):
+    def callback():
+        return EXTRACT_RESPONSE
+
+    http_testserver.add_callback("/", callback)
+    # the extract has 3 words, too many to be cached
+    wiki = WikiWordFrequency(10, http_testserver.url, "test", cache_size=3)
+    for _ in range(2):
+        key = wiki.add_job("test", 0)
+        while (result := wiki.get_result(key)) is None:
+            pass
+        assert result.words == {"here": 1, "words": 1, "Some": 1}
+    assert http_testserver.request_log == ["GET /", "GET /"]
+
+
+def test_wiki_broken_process_pool(http_testserver, mocker):
+    def callback():
+        return EXTRACT_RESPONSE
+
+    http_testserver.add_callback("/", callback)
+    wiki = WikiWordFrequency(10, http_testserver.url, "test")
+    broken = wiki._cpu_executor
+    mocker.patch.object(broken, "map", side_effect=BrokenProcessPool)
+    key = wiki.add_job("test", 0)
+    while (result := wiki.get_result(key)) is None:
+        pass
+    assert result.success
+    assert result.words == {"here": 1, "words": 1, "Some": 1}
+    assert wiki._cpu_executor is not broken
+    wiki.close()
+
+
+def test_filter_words_percentile():
+    words = {"a": 1, "b": 2, "c": 3, "d": 4, "e": 5}
+    assert _filter_words(dict(words), percentile=0) == {}
+    assert _filter_words(dict(words), percentile=100) == {
+        "a": 1,
+        "b": 2,
+        "c": 3,
+        "d": 4,
+    }
+    # rank 2 hits the third count exactly, threshold is 3
+    assert _filter_words(dict(words), percentile=50) == {"a": 1, "b": 2}
+    # rank 1.5 interpolates between 2 and 3
+    assert _filter_words({"a": 1, "b": 2, "c": 3, "d": 4}, percentile=50) == {
+        "a": 1,
+        "b": 2,
+    }
+    assert _filter_words({"a": 3}, percentile=50) == {}
+    assert _filter_words({"a": 3}, percentile=100) == {}
+    assert _filter_words({}, percentile=50) == {}
+
+
+def test_filter_words_ignore_list():
+    words = {"a": 1, "b": 1, "c": 2}
+    assert _filter_words(dict(words)) == words
+    assert _filter_words(dict(words), ignore_list=["a", "x"]) == {"b": 1, "c": 2}
+    assert _filter_words(dict(words), ["a"], 100) == {"b": 1}